@@ -1,82 +1,276 @@
 """
 Build ChromaDB vector database from invoice chunks
 """
-import json
+import hashlib
+import os
+import re
 import chromadb
-from sentence_transformers import SentenceTransformer
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
+from typing import List, Optional
+
+from embedding_utils import load_embedding_model
+
+# GPUs only saturate at much larger batches than CPUs
+DEFAULT_BATCH_SIZE = {"cpu": 32, "cuda": 256}
+
+# Sentences handed to each worker at a time during multi-process encoding
+MULTI_PROCESS_CHUNK_SIZE = 5000
+
+# Inserts allowed in flight while the next batch is encoded (bounds memory)
+MAX_PENDING_INSERTS = 2
+
+# Ids per collection.delete when pruning stale invoices
+DELETE_BATCH_SIZE = 10000
+
+# Chunk columns stored as flat ChromaDB metadata
+METADATA_COLUMNS = ["file_name", "source_index", "has_image"]
+
+# Embeddings are unit-normalized, so FP16 keeps ranking intact at half the size
+EMBEDDING_DTYPE = np.float16
+
+
+def embedding_cache_key(embedding_model: str, table: pa.Table) -> str:
+    """
+    Fingerprint the embedding model and chunk contents
+    
+    Any change to the model name or to a chunk's id or text produces a new key.
+    The id and text columns are hashed straight from their Arrow buffers, so no
+    Python strings are created.
+    """
+    digest = hashlib.sha256(embedding_model.encode('utf-8'))
+    for name in ("id", "text"):
+        # Value lengths and bytes are hashed separately, so the key doesn't
+        # depend on how the column happens to be split into chunks
+        lengths_digest = hashlib.sha256()
+        values_digest = hashlib.sha256()
+        for chunk in table.column(name).chunks:
+            if not len(chunk):
+                continue
+            
+            _, offsets, data = chunk.buffers()
+            offset_type = np.int64 if pa.types.is_large_string(chunk.type) else np.int32
+            offsets = np.frombuffer(offsets, dtype=offset_type)[chunk.offset:chunk.offset + len(chunk) + 1]
+            lengths_digest.update(np.diff(offsets).astype(np.int64).tobytes())
+            values_digest.update(memoryview(data)[offsets[0]:offsets[-1]])
+        digest.update(lengths_digest.digest() + values_digest.digest())
+    return digest.hexdigest()[:16]
+
+
+def embedding_cache_prefix(embedding_model: str) -> str:
+    """File name prefix shared by every cached embedding matrix of one model"""
+    return "emb_cache_" + re.sub(r"[^A-Za-z0-9.-]", "-", embedding_model) + "_"
 
 
 def build_invoice_vectordb(
-    chunks_file: str = "data/chunks.json",
+    chunks_file: str = "data/chunks.parquet",
     db_path: str = "./chroma_db",
     collection_name: str = "invoices_collection",
     embedding_model: str = "all-MiniLM-L6-v2",
-    batch_size: int = 32
+    batch_size: Optional[int] = None,
+    device: Optional[str] = None,
+    target_devices: Optional[List[str]] = None,
+    insert_batch_size: int = 5000,
+    cache_dir: Optional[str] = "data"
 ):
     """
     Build ChromaDB from invoice chunks
+    
+    Args:
+        batch_size: Chunks per embedding batch (defaults to a size suited to the device)
+        device: Device to run the embedding model on (defaults to CUDA when available;
+            unused when target_devices is set)
+        target_devices: Devices for multi-process encoding, e.g. ["cuda:0", "cuda:1"]
+            or ["cpu"] * 4 (defaults to every GPU when more than one is available)
+        insert_batch_size: Chunks per collection.upsert call, independent of the
+            embedding batch size since every write pays a full write transaction
+        cache_dir: Directory for the on-disk embedding cache (None disables it);
+            one matrix is kept per embedding model
     """
     print(f"Building invoice vector database...")
     
-    # Load chunks
+    # Load chunks as columns; structured_data isn't needed for indexing
     print(f"Loading chunks from {chunks_file}")
-    with open(chunks_file, 'r', encoding='utf-8') as f:
-        chunks = json.load(f)
+    table = pq.read_table(chunks_file, columns=["id", "text", *METADATA_COLUMNS])
+    num_chunks = table.num_rows
     
-    print(f"Total invoices: {len(chunks)}")
+    print(f"Total invoices: {num_chunks}")
     
-    # Initialize embedding model
-    print(f"Loading embedding model: {embedding_model}")
-    embedder = SentenceTransformer(embedding_model)
+    # Reuse embeddings from a previous build of the same chunks and model
+    cache_file = None
+    all_embeddings = None
+    if cache_dir is not None:
+        cache_key = embedding_cache_key(embedding_model, table)
+        cache_prefix = embedding_cache_prefix(embedding_model)
+        cache_file = Path(cache_dir) / f"{cache_prefix}{cache_key}.npy"
+        if cache_file.exists():
+            print(f"Loading cached embeddings from {cache_file}")
+            all_embeddings = np.load(cache_file, mmap_mode='r')
+            embedding_dim = all_embeddings.shape[1]
+    cache_hit = all_embeddings is not None
+    
+    if not cache_hit:
+        # Initialize embedding model
+        if target_devices is None and device is None and torch.cuda.device_count() > 1:
+            target_devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        if target_devices:
+            # The pool copies the model to each worker's device itself, so
+            # the parent copy stays on CPU
+            device = "cpu"
+            on_gpu = all(d.startswith("cuda") for d in target_devices)
+        else:
+            if device is None:
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+            on_gpu = device.startswith("cuda")
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE["cuda" if on_gpu else "cpu"]
+        
+        print(f"Loading embedding model: {embedding_model} ({device})")
+        embedder = load_embedding_model(embedding_model, device=device)
+        if on_gpu:
+            embedder.half()  # FP16 inference, only when every encoder runs on GPU
+        embedding_dim = embedder.get_sentence_embedding_dimension()
     
     # Initialize ChromaDB
     print(f"Initializing ChromaDB at {db_path}")
     client = chromadb.PersistentClient(path=db_path)
     
-    # Delete collection if exists
-    try:
+    # Reuse an existing collection and upsert into it, instead of dropping
+    # and rebuilding the whole HNSW index on every run. That is only valid
+    # when it was built with the same model, dimension and distance space.
+    collection_metadata = {
+        "hnsw:space": "cosine",
+        "embedding_model": embedding_model,
+        "embedding_dim": embedding_dim
+    }
+    existing = next(
+        (c for c in client.list_collections() if c.name == collection_name),
+        None
+    )
+    if existing is not None and existing.metadata != collection_metadata:
         client.delete_collection(name=collection_name)
-        print("Deleted existing collection")
-    except:
-        pass
+        print("Deleted existing collection built with a different embedding setup")
+        existing = None
     
-    # Create collection
-    collection = client.create_collection(
+    collection = client.get_or_create_collection(
         name=collection_name,
-        metadata={"hnsw:space": "cosine"}
+        metadata=collection_metadata
     )
     
-    # Process in batches
-    print(f"⚡ Generating embeddings and storing in ChromaDB...")
+    if existing is not None:
+        # Remove invoices that are no longer in the chunks file
+        chunk_ids = set(table.column("id").to_pylist())
+        stale_ids = [id_ for id_ in collection.get(include=[])["ids"] if id_ not in chunk_ids]
+        for i in range(0, len(stale_ids), DELETE_BATCH_SIZE):
+            collection.delete(ids=stale_ids[i:i+DELETE_BATCH_SIZE])
+        if stale_ids:
+            print(f"Deleted {len(stale_ids)} stale invoices")
     
-    for i in tqdm(range(0, len(chunks), batch_size)):
-        batch = chunks[i:i+batch_size]
-        
-        ids = [chunk["id"] for chunk in batch]
-        texts = [chunk["text"] for chunk in batch]
+    # Smart batching: encode chunks in order of text length so each batch
+    # pads to a similar length instead of to its longest outlier
+    order = np.argsort(pc.utf8_length(table.column("text")).to_numpy(), kind="stable")
+    
+    if cache_hit:
+        print(f"Storing cached embeddings in ChromaDB...")
+    elif target_devices:
+        # Split -> parallel encode -> combine, one worker process per device
+        print(f"⚡ Generating embeddings on {len(target_devices)} workers...")
+        pool = embedder.start_multi_process_pool(target_devices)
+        try:
+            sorted_embeddings = embedder.encode_multi_process(
+                table.column("text").take(order).to_pylist(),
+                pool,
+                batch_size=batch_size,
+                chunk_size=MULTI_PROCESS_CHUNK_SIZE,
+                normalize_embeddings=True
+            ).astype(EMBEDDING_DTYPE, copy=False)
+        finally:
+            embedder.stop_multi_process_pool(pool)
         
-        # Prepare metadata (ChromaDB doesn't support nested dicts well)
-        metadatas = []
-        for chunk in batch:
-            meta = {
-                "file_name": chunk["metadata"]["file_name"],
-                "source_index": chunk["metadata"]["source_index"],
-                "has_image": chunk["metadata"]["has_image"]
-            }
-            metadatas.append(meta)
+        # Scatter back to chunk order
+        all_embeddings = np.empty_like(sorted_embeddings)
+        all_embeddings[order] = sorted_embeddings
+        del sorted_embeddings
+        print(f"Storing embeddings in ChromaDB...")
+    else:
+        if cache_file is not None:
+            all_embeddings = np.empty(
+                (num_chunks, embedder.get_sentence_embedding_dimension()),
+                dtype=EMBEDDING_DTYPE
+            )
+        print(f"⚡ Generating embeddings and storing in ChromaDB...")
+    
+    # Process in batches, one collection.upsert per insert batch. Inserts run on
+    # a background thread so the encoder never waits on a database write;
+    # a single writer keeps SQLite free of lock contention.
+    insert_size = min(insert_batch_size, client.max_batch_size)
+    progress = tqdm(total=num_chunks)
+    pending = deque()
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for i in range(0, num_chunks, insert_size):
+            batch_idx = order[i:i+insert_size]
+            batch = table.take(batch_idx)
+            ids = batch.column("id").to_pylist()
+            texts = batch.column("text").to_pylist()
+            
+            # Metadata rows come straight from the flat columns
+            metadatas = batch.select(METADATA_COLUMNS).to_pylist()
+            
+            if cache_hit or target_devices:
+                embeddings = all_embeddings[batch_idx]
+            else:
+                # Generate embeddings (normalized, so cosine distance is a dot product)
+                embeddings = embedder.encode(
+                    texts,
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False
+                ).astype(EMBEDDING_DTYPE, copy=False)
+                if all_embeddings is not None:
+                    all_embeddings[batch_idx] = embeddings
+            
+            # Upsert into ChromaDB
+            if len(pending) >= MAX_PENDING_INSERTS:
+                pending.popleft().result()
+            future = executor.submit(
+                collection.upsert,
+                ids=ids,
+                documents=texts,
+                embeddings=embeddings,
+                metadatas=metadatas
+            )
+            future.add_done_callback(lambda _, n=len(ids): progress.update(n))
+            pending.append(future)
         
-        # Generate embeddings
-        embeddings = embedder.encode(texts, show_progress_bar=False)
+        # Surface any insert errors
+        for future in pending:
+            future.result()
+    
+    progress.close()
+    
+    if cache_file is not None and not cache_hit:
+        # Write to a temp file first so an interrupted save is never picked up
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(".npy.tmp")
+        with open(tmp_file, 'wb') as f:
+            np.save(f, all_embeddings)
+        os.replace(tmp_file, cache_file)
+        print(f"Cached embeddings to {cache_file}")
         
-        # Add to ChromaDB
-        collection.add(
-            ids=ids,
-            documents=texts,
-            embeddings=embeddings.tolist(),
-            metadatas=metadatas
-        )
+        # Only the latest matrix per model is useful; drop older ones
+        for old_file in cache_file.parent.glob(f"{cache_prefix}*.npy"):
+            if old_file != cache_file:
+                old_file.unlink()
+                print(f"Removed stale embedding cache {old_file}")
     
     print(f"\nInvoice vector database built successfully!")
     print(f"Location: {db_path}")
@@ -88,9 +282,8 @@ def build_invoice_vectordb(
 
 if __name__ == "__main__":
     build_invoice_vectordb(
-        chunks_file="data/chunks.json",
+        chunks_file="data/chunks.parquet",
         db_path="./chroma_db",
         collection_name="invoices_collection",
-        embedding_model="all-MiniLM-L6-v2",
-        batch_size=32
+        embedding_model="all-MiniLM-L6-v2"
     )
\ No newline at end of file
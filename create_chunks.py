@@ -1,109 +1,190 @@
 """
 Create semantic chunks from invoice data
 """
+import io
 import json
-from typing import List, Dict
+import sys
+import ijson
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Dict, Iterator, Optional
 from pathlib import Path
 
 
-def format_invoice_as_text(invoice_data: Dict) -> str:
+# Common invoice fields (adjust based on actual structure)
+FIELD_MAPPING = {
+    'company': 'Company',
+    'vendor': 'Vendor',
+    'invoice_number': 'Invoice Number',
+    'invoice_date': 'Date',
+    'due_date': 'Due Date',
+    'total': 'Total Amount',
+    'subtotal': 'Subtotal',
+    'tax': 'Tax',
+    'address': 'Address',
+    'items': 'Line Items'
+}
+
+# Field schema compiled once at import instead of per invoice. The
+# "Label: " prefixes are interned so every chunk shares one copy of each.
+_FIELD_PREFIXES = tuple(
+    (field, sys.intern(f"{label}: ")) for field, label in FIELD_MAPPING.items()
+)
+_FIELD_KEYS = frozenset(FIELD_MAPPING)
+
+# Columnar chunk layout; structured_data holds the original fields as JSON
+CHUNK_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("text", pa.string()),
+    ("file_name", pa.string()),
+    ("source_index", pa.int64()),
+    ("has_image", pa.bool_()),
+    ("structured_data", pa.string())
+])
+
+# Chunks buffered per Parquet row group
+ROW_GROUP_SIZE = 10000
+
+
+def format_invoice_as_text(invoice_data: Dict, buffer: Optional[io.StringIO] = None) -> str:
     """
     Convert structured invoice data to searchable text
     
     Args:
         invoice_data: Parsed invoice fields
+        buffer: Scratch buffer reused across invoices; it is cleared before use
     
     Returns:
         Formatted text representation
     """
-    text_parts = []
-    
-    # Common invoice fields (adjust based on actual structure)
-    field_mapping = {
-        'company': 'Company',
-        'vendor': 'Vendor',
-        'invoice_number': 'Invoice Number',
-        'invoice_date': 'Date',
-        'due_date': 'Due Date',
-        'total': 'Total Amount',
-        'subtotal': 'Subtotal',
-        'tax': 'Tax',
-        'address': 'Address',
-        'items': 'Line Items'
-    }
-    
-    for field, label in field_mapping.items():
+    if buffer is None:
+        buffer = io.StringIO()
+    else:
+        buffer.seek(0)
+        buffer.truncate()
+    
+    write = buffer.write
+    dumps = json.dumps
+    separator = ""
+    
+    for field, prefix in _FIELD_PREFIXES:
         if field in invoice_data:
             value = invoice_data[field]
+            value_type = type(value)
             
             # Handle nested structures
-            if isinstance(value, list):
-                if value:  # Non-empty list
-                    text_parts.append(f"{label}: {', '.join(str(v) for v in value)}")
-            elif isinstance(value, dict):
-                text_parts.append(f"{label}: {json.dumps(value)}")
-            elif value:  # Non-empty value
-                text_parts.append(f"{label}: {value}")
+            if value_type is list:
+                if not value:  # Skip empty list
+                    continue
+                value = ', '.join(map(str, value))
+            elif value_type is dict:
+                value = dumps(value)
+            elif not value:  # Skip empty value
+                continue
+            
+            write(separator)
+            write(prefix)
+            write(str(value))
+            separator = "\n"
     
     # Add any other fields not in mapping
     for key, value in invoice_data.items():
-        if key not in field_mapping and value:
-            text_parts.append(f"{key}: {value}")
+        if value and key not in _FIELD_KEYS:
+            write(separator)
+            write(str(key))
+            write(": ")
+            write(str(value))
+            separator = "\n"
     
-    return "\n".join(text_parts)
+    return buffer.getvalue()
+
+
+def iter_invoice_chunks(data_file: str = "data/invoices_data.json") -> Iterator[Dict]:
+    """
+    Lazily yield searchable chunks from invoice data
+    
+    The invoice file is stream-parsed, so only the current invoice is held
+    in memory. Each invoice becomes one chunk (invoices are already atomic)
+    """
+    buffer = io.StringIO()
+    
+    with open(data_file, 'rb') as f:
+        for invoice in ijson.items(f, 'item', use_float=True):
+            # Convert invoice to searchable text
+            text = format_invoice_as_text(invoice['data'], buffer)
+            
+            # Add file name context
+            full_text = f"Invoice: {invoice['file_name']}\n\n{text}"
+            
+            yield {
+                "id": invoice['id'],
+                "text": full_text,
+                "metadata": {
+                    "file_name": invoice['file_name'],
+                    "source_index": invoice['metadata']['source_index'],
+                    "has_image": invoice['metadata']['has_image'],
+                    "structured_data": invoice['data']  # Keep original structured data
+                }
+            }
 
 
 def create_invoice_chunks(
     data_file: str = "data/invoices_data.json",
-    output_file: str = "data/chunks.json"
-) -> List[Dict]:
+    output_file: str = "data/chunks.parquet"
+) -> int:
     """
     Create searchable chunks from invoice data
     
-    Each invoice becomes one chunk (invoices are already atomic)
+    Chunks are written to a Parquet file one row group at a time instead of
+    being buffered, so memory stays bounded regardless of dataset size.
+    
+    Returns:
+        Number of chunks written
     """
     print(f"Loading invoice data from {data_file}")
     
-    with open(data_file, 'r', encoding='utf-8') as f:
-        invoices = json.load(f)
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
     
-    chunks = []
+    num_chunks = 0
+    sample_text = None
     
-    for invoice in invoices:
-        # Convert invoice to searchable text
-        text = format_invoice_as_text(invoice['data'])
-        
-        # Add file name context
-        full_text = f"Invoice: {invoice['file_name']}\n\n{text}"
-        
-        chunks.append({
-            "id": invoice['id'],
-            "text": full_text,
-            "metadata": {
-                "file_name": invoice['file_name'],
-                "source_index": invoice['metadata']['source_index'],
-                "has_image": invoice['metadata']['has_image'],
-                "structured_data": invoice['data']  # Keep original structured data
-            }
-        })
+    columns = {name: [] for name in CHUNK_SCHEMA.names}
     
-    # Save chunks
-    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(chunks, f, indent=2, ensure_ascii=False)
+    with pq.ParquetWriter(output_file, CHUNK_SCHEMA, compression='snappy') as writer:
+        for chunk in iter_invoice_chunks(data_file):
+            if sample_text is None:
+                sample_text = chunk['text']
+            
+            metadata = chunk['metadata']
+            columns['id'].append(chunk['id'])
+            columns['text'].append(chunk['text'])
+            columns['file_name'].append(metadata['file_name'])
+            columns['source_index'].append(metadata['source_index'])
+            columns['has_image'].append(metadata['has_image'])
+            columns['structured_data'].append(orjson.dumps(metadata['structured_data']).decode())
+            num_chunks += 1
+            
+            if len(columns['id']) >= ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_pydict(columns, schema=CHUNK_SCHEMA))
+                columns = {name: [] for name in CHUNK_SCHEMA.names}
+        
+        if columns['id']:
+            writer.write_table(pa.Table.from_pydict(columns, schema=CHUNK_SCHEMA))
     
-    print(f"Created {len(chunks)} invoice chunks")
+    print(f"Created {num_chunks} invoice chunks")
     print(f"Saved to {output_file}")
     
     # Show sample
-    print("\nSample chunk:")
-    print(chunks[0]['text'][:500])
+    if sample_text is not None:
+        print("\nSample chunk:")
+        print(sample_text[:500])
     
-    return chunks
+    return num_chunks
 
 
 if __name__ == "__main__":
-    chunks = create_invoice_chunks(
+    create_invoice_chunks(
         data_file="data/invoices_data.json",
-        output_file="data/chunks.json"
+        output_file="data/chunks.parquet"
     )
\ No newline at end of file
@@ -1,8 +1,11 @@
 """
 Download invoice dataset from Hugging Face
 """
-from datasets import load_dataset
-import json
+from datasets import Image as ImageFeature, load_dataset
+import orjson
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
 
@@ -19,6 +22,9 @@ def download_invoice_dataset(
         dataset_name: HuggingFace dataset identifier
         output_dir: Directory to save processed data
         save_images: Whether to save invoice images locally
+    
+    Returns:
+        Number of invoices processed
     """
     print(f"Downloading dataset: {dataset_name}")
     
@@ -27,46 +33,70 @@ def download_invoice_dataset(
     if save_images:
         Path(f"{output_dir}/images").mkdir(exist_ok=True)
     
-    # Load dataset
-    ds = load_dataset(dataset_name)
+    # Stream the train split record by record instead of loading it whole
+    ds = load_dataset(dataset_name, split='train', streaming=True)
     
-    # Process train split
-    processed_data = []
+    # Keep images as raw bytes unless they are saved, so they are never decoded
+    if not save_images and ds.features and 'image' in ds.features:
+        ds = ds.cast_column('image', ImageFeature(decode=False))
     
-    for idx, item in enumerate(ds['train']):
-        # Extract ground truth (invoice data)
-        ground_truth = json.loads(item['ground_truth'])
-        
-        invoice_data = {
-            "id": f"invoice_{idx}",
-            "file_name": item.get('file_name', f"invoice_{idx}"),
-            "data": ground_truth.get('gt_parse', {}),
-            "metadata": {
-                "source_index": idx,
-                "has_image": 'image' in item
+    # Process train split, writing each invoice out as soon as it is built
+    output_file = f"{output_dir}/invoices_data.json"
+    num_invoices = 0
+    sample_invoice = None
+    
+    # Images are saved on worker threads; PIL releases the GIL while encoding.
+    # In-flight saves are capped so decoded images don't pile up in memory.
+    image_workers = os.cpu_count() or 1
+    pending_saves = deque()
+    
+    with open(output_file, 'wb') as f, ThreadPoolExecutor(max_workers=image_workers) as executor:
+        f.write(b"[\n")
+        for idx, item in enumerate(ds):
+            # Extract ground truth (invoice data)
+            ground_truth = orjson.loads(item['ground_truth'])
+            
+            invoice_data = {
+                "id": f"invoice_{idx}",
+                "file_name": item.get('file_name', f"invoice_{idx}"),
+                "data": ground_truth.get('gt_parse', {}),
+                "metadata": {
+                    "source_index": idx,
+                    "has_image": 'image' in item
+                }
             }
-        }
-        
-        processed_data.append(invoice_data)
+            
+            if num_invoices:
+                f.write(b",\n")
+            else:
+                sample_invoice = invoice_data
+            f.write(orjson.dumps(invoice_data))
+            num_invoices += 1
+            
+            # Optionally save images
+            if save_images and 'image' in item:
+                img_path = f"{output_dir}/images/invoice_{idx}.png"
+                if len(pending_saves) >= 2 * image_workers:
+                    pending_saves.popleft().result()
+                pending_saves.append(
+                    # Low compression level trades file size for save speed
+                    executor.submit(item['image'].save, img_path, 'PNG', compress_level=1)
+                )
+        f.write(b"\n]\n")
         
-        # Optionally save images
-        if save_images and 'image' in item:
-            img_path = f"{output_dir}/images/invoice_{idx}.png"
-            item['image'].save(img_path)
-    
-    # Save processed data
-    output_file = f"{output_dir}/invoices_data.json"
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(processed_data, f, indent=2, ensure_ascii=False)
+        # Surface any image save errors
+        for future in pending_saves:
+            future.result()
     
-    print(f"Processed {len(processed_data)} invoices")
+    print(f"Processed {num_invoices} invoices")
     print(f"Saved to {output_file}")
     
     # Show sample structure
-    print("\nSample invoice structure:")
-    print(json.dumps(processed_data[0], indent=2))
+    if sample_invoice is not None:
+        print("\nSample invoice structure:")
+        print(orjson.dumps(sample_invoice, option=orjson.OPT_INDENT_2).decode())
     
-    return processed_data
+    return num_invoices
 
 
 if __name__ == "__main__":
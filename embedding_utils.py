@@ -0,0 +1,21 @@
+"""
+Shared embedding model loading for the build and query scripts
+"""
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+from typing import Optional
+
+
+def load_embedding_model(embedding_model: str, device: Optional[str] = None) -> SentenceTransformer:
+    """
+    Load a SentenceTransformer backed by the fast (Rust) tokenizer
+    
+    Models that ship a slow tokenizer get a fast one swapped in
+    """
+    embedder = SentenceTransformer(embedding_model, device=device)
+    if not embedder.tokenizer.is_fast:
+        embedder.tokenizer = AutoTokenizer.from_pretrained(
+            embedder.tokenizer.name_or_path,
+            use_fast=True
+        )
+    return embedder
@@ -4,10 +4,138 @@ Invoice RAG Query System using ChromaDB + Gemini
 import os
 import json
 import chromadb
-from sentence_transformers import SentenceTransformer
+import numpy as np
+import shutil
+import torch
+from collections import OrderedDict
+from pathlib import Path
 import google.generativeai as genai
 from dotenv import load_dotenv
-from typing import List, Dict
+from typing import List, Dict, Optional, Union
+
+from embedding_utils import load_embedding_model
+
+
+class OnnxSentenceEncoder:
+    """
+    INT8-quantized ONNX Runtime drop-in for SentenceTransformer.encode
+    
+    Reproduces the mean pooling + L2 normalization pipeline of the
+    sentence-transformers MiniLM/MPNet models. The model is exported and
+    quantized into onnx_model_path on first use.
+    
+    ONNX Runtime, optimum and transformers are imported here rather than at
+    module level, so they are only required (and paid for) when used.
+    """
+    
+    quantized_file_name = "model_quantized.onnx"
+    config_file_name = "sentence_bert_config.json"
+    
+    def __init__(
+        self,
+        embedding_model: str,
+        onnx_model_path: str,
+        max_seq_length: Optional[int] = None
+    ):
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        model_dir = Path(onnx_model_path)
+        if not (model_dir / self.quantized_file_name).exists():
+            self.export(embedding_model, model_dir)
+        
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=self.quantized_file_name,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        
+        # Truncate exactly like the sentence-transformers model used at build time
+        if max_seq_length is None:
+            config_file = model_dir / self.config_file_name
+            if config_file.exists():
+                with open(config_file, 'r', encoding='utf-8') as f:
+                    max_seq_length = json.load(f).get("max_seq_length")
+        self.max_seq_length = max_seq_length or self.tokenizer.model_max_length
+    
+    @classmethod
+    def export(cls, embedding_model: str, model_dir: Path):
+        """Export the model to ONNX and quantize its weights to INT8"""
+        from huggingface_hub import hf_hub_download
+        from huggingface_hub.utils import EntryNotFoundError
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        # Short sentence-transformers names live under that org on the Hub
+        model_id = embedding_model
+        if "/" not in model_id and not Path(model_id).exists():
+            model_id = f"sentence-transformers/{model_id}"
+        
+        print(f"Exporting {model_id} to ONNX: {model_dir}")
+        model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+        model.save_pretrained(model_dir)
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+        
+        # Keep the sentence-transformers config for its max_seq_length
+        if Path(model_id).is_dir():
+            config_file = Path(model_id) / cls.config_file_name
+            if config_file.exists():
+                shutil.copy(config_file, model_dir / cls.config_file_name)
+        else:
+            try:
+                shutil.copy(
+                    hf_hub_download(model_id, cls.config_file_name),
+                    model_dir / cls.config_file_name
+                )
+            except EntryNotFoundError:
+                print(f"No {cls.config_file_name} for {model_id}; using tokenizer max length")
+        
+        quantize_dynamic(
+            model_input=model_dir / "model.onnx",
+            model_output=model_dir / cls.quantized_file_name,
+            weight_type=QuantType.QInt8
+        )
+    
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        normalize_embeddings: bool = True,
+        **kwargs
+    ) -> np.ndarray:
+        """Embed one sentence (1-D result) or a list of sentences (2-D result)"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            features = self.tokenizer(
+                sentences[start:start+batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            token_embeddings = self.model(**features).last_hidden_state
+            
+            # Mean pooling over non-padding tokens
+            mask = features["attention_mask"][..., None].astype(token_embeddings.dtype)
+            summed = (token_embeddings * mask).sum(axis=1)
+            batches.append(summed / np.clip(mask.sum(axis=1), 1e-9, None))
+        
+        embeddings = np.concatenate(batches).astype(np.float32, copy=False)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        
+        return embeddings[0] if single else embeddings
 
 
 class InvoiceRAG:
@@ -15,9 +143,23 @@ class InvoiceRAG:
         self,
         db_path: str = "./chroma_db",
         collection_name: str = "invoices_collection",
-        embedding_model: str = "all-MiniLM-L6-v2"
+        embedding_model: str = "all-MiniLM-L6-v2",
+        query_cache_size: int = 1024,
+        num_threads: Optional[int] = None,
+        onnx_model_path: Optional[str] = None,
+        in_memory_max_size: int = 100_000
     ):
-        """Initialize Invoice RAG system"""
+        """
+        Initialize Invoice RAG system
+        
+        Args:
+            onnx_model_path: Directory of an INT8 ONNX export of embedding_model,
+                created on first use; when set, queries are embedded with ONNX
+                Runtime instead of PyTorch
+            in_memory_max_size: Collections up to this many invoices are loaded
+                into RAM and searched with an exact matrix product instead of
+                the HNSW index (0 disables preloading)
+        """
         load_dotenv()
         
         # Configure Gemini
@@ -28,20 +170,128 @@ class InvoiceRAG:
         genai.configure(api_key=api_key)
         self.llm = genai.GenerativeModel('gemini-2.5-flash')
         
+        # Size torch's intra-op pool for single-query CPU encoding
+        torch.set_num_threads(num_threads or max(1, (os.cpu_count() or 2) // 2))
+        
         # Load embedding model
-        print(f"Loading embedding model: {embedding_model}")
-        self.embedder = SentenceTransformer(embedding_model)
+        if onnx_model_path:
+            print(f"Loading ONNX embedding model: {onnx_model_path}")
+            self.embedder = OnnxSentenceEncoder(embedding_model, onnx_model_path)
+        else:
+            print(f"Loading embedding model: {embedding_model}")
+            self.embedder = load_embedding_model(embedding_model)
+            self.embedder.eval()
+        
+        # LRU cache of query embeddings, so repeated queries skip the encoder
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
         
         # Connect to ChromaDB
         print(f"Connecting to ChromaDB: {db_path}")
         client = chromadb.PersistentClient(path=db_path)
         self.collection = client.get_collection(name=collection_name)
+        count = self.collection.count()
+        
+        # Small collections: brute-force cosine over a dense matrix beats HNSW
+        self.index_embeddings = None
+        if 0 < count <= in_memory_max_size:
+            print("Preloading collection into memory")
+            self.load_index()
+        
+        print(f"Invoice RAG ready! ({count} invoices indexed)")
+    
+    def load_index(self):
+        """Load every embedding, document and metadata from the collection into RAM"""
+        records = self.collection.get(include=['embeddings', 'documents', 'metadatas'])
+        
+        embeddings = np.asarray(records['embeddings'], dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        
+        self.index_ids = records['ids']
+        self.index_documents = records['documents']
+        self.index_metadatas = records['metadatas']
+        self.index_embeddings = embeddings
+    
+    def query_index(self, query_embeddings: np.ndarray, n_results: int = 5) -> Dict:
+        """Exact cosine search over the in-memory index, in collection.query's format"""
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        query_embeddings = query_embeddings / np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+        
+        scores = query_embeddings @ self.index_embeddings.T
+        n_results = min(n_results, scores.shape[1])
+        
+        # Unordered top-k per query, then sort only those k
+        top = np.argpartition(-scores, n_results - 1, axis=1)[:, :n_results]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        
+        return {
+            'ids': [[self.index_ids[j] for j in row] for row in top],
+            'documents': [[self.index_documents[j] for j in row] for row in top],
+            'metadatas': [[self.index_metadatas[j] for j in row] for row in top],
+            'distances': (1.0 - top_scores).tolist()
+        }
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """Embed a query, reusing the cached embedding for repeated queries"""
+        # Whitespace differences don't change the tokenized query
+        key = " ".join(query.split())
+        
+        query_embedding = self._query_cache.get(key)
+        if query_embedding is not None:
+            self._query_cache.move_to_end(key)
+            return query_embedding
+        
+        with torch.inference_mode():
+            query_embedding = self.embedder.encode(key)
+        self._cache_query_embedding(key, query_embedding)
+        
+        return query_embedding
+    
+    def embed_queries(self, queries: List[str], batch_size: int = 64) -> np.ndarray:
+        """Embed many queries, encoding all cache misses in a single call"""
+        keys = [" ".join(query.split()) for query in queries]
+        
+        embeddings = {}
+        for key in keys:
+            if key in self._query_cache and key not in embeddings:
+                self._query_cache.move_to_end(key)
+                embeddings[key] = self._query_cache[key]
+        
+        missing = [key for key in dict.fromkeys(keys) if key not in embeddings]
+        if missing:
+            with torch.inference_mode():
+                encoded = self.embedder.encode(
+                    missing,
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                )
+            for key, query_embedding in zip(missing, encoded):
+                embeddings[key] = query_embedding
+                self._cache_query_embedding(key, query_embedding)
         
-        print(f"Invoice RAG ready! ({self.collection.count()} invoices indexed)")
+        return np.stack([embeddings[key] for key in keys])
+    
+    def _cache_query_embedding(self, key: str, query_embedding: np.ndarray):
+        """Store a query embedding, evicting the least recently used entry"""
+        if self.query_cache_size > 0:
+            # Own, read-only copy: callers can't corrupt the entry in place, and
+            # a row of a batch result doesn't keep the whole batch alive
+            query_embedding = query_embedding.copy()
+            query_embedding.setflags(write=False)
+            self._query_cache[key] = query_embedding
+            if len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
     
     def retrieve(self, query: str, n_results: int = 5) -> Dict:
         """Retrieve relevant invoices from vector DB"""
-        query_embedding = self.embedder.encode(query)
+        query_embedding = self.embed_query(query)
+        
+        if self.index_embeddings is not None:
+            return self.query_index(query_embedding, n_results)
         
         results = self.collection.query(
             query_embeddings=[query_embedding.tolist()],
@@ -50,6 +300,27 @@ class InvoiceRAG:
         
         return results
     
+    def retrieve_batch(self, queries: List[str], n_results: int = 5) -> List[Dict]:
+        """Retrieve relevant invoices for many queries, one result dict per query"""
+        if not queries:
+            return []
+        
+        query_embeddings = self.embed_queries(queries)
+        
+        if self.index_embeddings is not None:
+            results = self.query_index(query_embeddings, n_results)
+        else:
+            results = self.collection.query(
+                query_embeddings=query_embeddings.tolist(),
+                n_results=n_results
+            )
+        
+        # Split into the same shape retrieve() returns for a single query
+        return [
+            {key: None if value is None else [value[i]] for key, value in results.items()}
+            for i in range(len(queries))
+        ]
+    
     def format_retrieved_context(self, results: Dict) -> str:
         """Format retrieved invoices for LLM"""
         documents = results['documents'][0]